@@ -3,14 +3,25 @@ Flask Backend API for Pigment-to-Order Matcher
 Matches pigments to the closest customer orders
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import pandas as pd
 import numpy as np
 from sklearn.neighbors import NearestNeighbors
 from sklearn.preprocessing import StandardScaler
 from sklearn.metrics.pairwise import cosine_similarity
+from openpyxl import Workbook
+from werkzeug.utils import secure_filename
 import os
+import io
+import csv
+import json
+import struct
+import tempfile
+import threading
+import uuid
+from collections import deque
+from urllib.parse import quote
 
 app = Flask(__name__)
 app.secret_key = 'pigment-matcher-secret-key-2024'
@@ -36,12 +47,89 @@ databases = {
     'orders': None
 }
 
+# Row identifier column for each table, used to diff uploads
+TABLE_ID_COLUMNS = {
+    'pigments': 'PigmentID',
+    'orders': 'OrderID'
+}
+
+# Maximum row changes kept per table before the oldest are compacted away
+CHANGE_LOG_MAX_ENTRIES = 10000
+
+# Dataset version and per-table change log for delta sync.
+# Each log entry is (version, op, row_id, row). 'floor' is the oldest version
+# a client can sync from; anything older needs a full reload.
+dataset_state = {
+    'version': 0,
+    'changes': {'pigments': deque(), 'orders': deque()},
+    'floor': {'pigments': 0, 'orders': 0}
+}
+dataset_lock = threading.Lock()
+
+# Versions restart after a restart and count independently in each worker, so
+# a version is only meaningful with its epoch: a random token created at startup
+# and renewed when a forked worker first changes its own copy of the data.
+dataset_epoch_state = {
+    'token': uuid.uuid4().hex,
+    'pid': os.getpid()
+}
+
+# Orders table together with its sub-indexes (see build_order_index). Replaced
+# as a whole so readers never pair a table with another table's index.
+order_index = None
+
 # Priority calibration parameters
 # Only consider orders with Delta E below this as candidates for priority
 DELTA_E_MAX_FOR_PRIORITY = 1.5
 # Orders must be within this Delta E difference to be considered a "tie"
 DELTA_E_TIE_THRESHOLD = 0.2
 
+# Point cloud level-of-detail parameters
+# Voxel edge length (Delta E units) at detail level 0; each level halves it
+VIZ_BASE_VOXEL_SIZE = 16.0
+VIZ_MAX_LEVEL = 6
+VIZ_DEFAULT_LEVEL = 2
+# Points within this Delta E of the selected pigment are always sent unaggregated
+VIZ_EXACT_RADIUS = 5.0
+VIZ_MAX_RADIUS = 20.0
+# Cap on unaggregated points; the nearest are kept and the rest voxelized
+VIZ_MAX_EXACT_POINTS = 2000
+
+# Default grid for the priority threshold sweep
+SWEEP_DEFAULT_MAX_DELTA_E = [0.5, 1.0, 1.5, 2.0, 2.5, 3.0]
+SWEEP_DEFAULT_TIE_THRESHOLD = [0.05, 0.1, 0.2, 0.3, 0.5]
+# Match lists that carry priority tags
+PRIORITY_METHODS = ['euclidean', 'cosine', 'knn', 'consensus']
+
+# Export parameters
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx')
+}
+# Approximate bytes buffered before a chunk is sent to the client
+EXPORT_CHUNK_SIZE = 64 * 1024
+# Excel's row limit per worksheet, header included
+EXCEL_MAX_ROWS = 1048576
+MATCH_EXPORT_COLUMNS = [
+    'PigmentID', 'Method', 'Rank', 'OrderID', 'CustomerName', 'L', 'a', 'b',
+    'RequiredTonnage', 'DeltaE', 'Score', 'Interpretation', 'Priority',
+    'FulfillmentStatus', 'CanFulfill',
+    # Per-pigment production recommendation, repeated on each of its rows
+    'AvailableTonnage', 'RecommendationStatus', 'TotalRequired', 'Shortage',
+    'ProductionRecommendation', 'PriorityRequired'
+]
+# (method, Delta E key, score key) for each match list in an export
+MATCH_EXPORT_METHODS = [
+    ('euclidean', 'deltaE', 'matchPercentage'),
+    ('cosine', 'euclideanDistance', 'similarity'),
+    ('knn', 'rawDistance', 'matchPercentage'),
+    ('consensus', 'euclideanDeltaE', 'consensusScore')
+]
+CROSS_MATCH_EXPORT_COLUMNS = [
+    'PigmentID', 'Rank', 'OrderID', 'CustomerName', 'DeltaE',
+    'AvailableTonnage', 'RequiredTonnage'
+]
+
 
 def lab_to_hex(L, a, b):
     """Convert L*a*b* to HEX color."""
@@ -77,6 +165,28 @@ def lab_to_hex(L, a, b):
     return '#{:02x}{:02x}{:02x}'.format(int(R*255), int(G*255), int(B*255))
 
 
+def lab_to_rgb_array(lab):
+    """Vectorised lab_to_hex: convert an (n, 3) L*a*b* array to (n, 3) uint8 RGB."""
+    lab = np.asarray(lab, dtype=float).reshape(-1, 3)
+    y = (lab[:, 0] + 16) / 116
+    x = lab[:, 1] / 500 + y
+    z = y - lab[:, 2] / 200
+    
+    xyz = np.column_stack([x, y, z])
+    xyz = np.where(xyz > 0.206893, xyz ** 3, (xyz - 16/116) / 7.787)
+    xyz = xyz * np.array([0.95047, 1.00000, 1.08883])
+    
+    matrix = np.array([
+        [3.2406, -1.5372, -0.4986],
+        [-0.9689, 1.8758, 0.0415],
+        [0.0557, -0.2040, 1.0570]
+    ])
+    rgb = xyz @ matrix.T
+    rgb = np.where(rgb > 0.0031308, 1.055 * (np.abs(rgb) ** (1/2.4)) - 0.055, 12.92 * rgb)
+    
+    return (np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+
+
 def get_delta_e_interpretation(delta_e):
     """Get interpretation of Delta E value."""
     if delta_e < 1:
@@ -249,6 +359,193 @@ def generate_sample_orders():
     return pd.DataFrame(data)
 
 
+def table_records(df):
+    """Convert a table to JSON-safe records with NaN replaced by None."""
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+def diff_tables(old_df, new_df, id_col):
+    """
+    Compare two versions of a table row by row.
+    
+    Args:
+        old_df: Table currently loaded
+        new_df: Replacement table
+        id_col: Column identifying a row across versions
+    
+    Returns:
+        List of (op, row_id, row) tuples with op in 'insert', 'update', 'delete'
+    """
+    old_rows = {str(row[id_col]): row for row in table_records(old_df)}
+    new_rows = {str(row[id_col]): row for row in table_records(new_df)}
+    
+    changes = []
+    for row_id, row in new_rows.items():
+        old_row = old_rows.get(row_id)
+        if old_row is None:
+            changes.append(('insert', row_id, row))
+        elif old_row != row:
+            changes.append(('update', row_id, row))
+    
+    for row_id in old_rows:
+        if row_id not in new_rows:
+            changes.append(('delete', row_id, None))
+    
+    return changes
+
+
+def dataset_epoch():
+    """Identify this process's dataset history."""
+    return dataset_epoch_state['token']
+
+
+def set_database(table, df):
+    """
+    Replace a table, bump the dataset version and log the row-level changes.
+    
+    Returns:
+        The new dataset version
+    """
+    global order_index
+    
+    # Build derived state first so a bad table leaves everything untouched
+    new_index = build_order_index(df) if table == 'orders' else None
+    
+    with dataset_lock:
+        version = dataset_state['version'] + 1
+        old_df = databases[table]
+        log = dataset_state['changes'][table]
+        
+        if old_df is None or TABLE_ID_COLUMNS[table] not in old_df.columns:
+            # Nothing to diff against: clients must load this table in full
+            log.clear()
+            dataset_state['floor'][table] = version
+        else:
+            for op, row_id, row in diff_tables(old_df, df, TABLE_ID_COLUMNS[table]):
+                log.append((version, op, row_id, row))
+        
+        # Compact: once an entry is dropped, clients older than it must reload
+        while len(log) > CHANGE_LOG_MAX_ENTRIES:
+            dataset_state['floor'][table] = log.popleft()[0]
+        
+        databases[table] = df
+        dataset_state['version'] = version
+        # A forked worker inherits its parent's history until it diverges here
+        if dataset_epoch_state['pid'] != os.getpid():
+            dataset_epoch_state['token'] = uuid.uuid4().hex
+            dataset_epoch_state['pid'] = os.getpid()
+        if new_index is not None:
+            order_index = new_index
+    
+    return version
+
+
+def build_order_index(orders_db):
+    """
+    Build per-customer and tonnage sub-indexes over the orders table.
+    
+    Row positions are kept sorted by RequiredTonnage, overall and per customer,
+    so a minimum tonnage filter is a binary search plus a slice. The KNN scaler
+    is fitted on the full table so filtered searches keep the same normalisation.
+    
+    Returns:
+        Dictionary holding the orders table itself and its indexes
+    """
+    tonnages = orders_db['RequiredTonnage'].values.astype(float)
+    positions = np.argsort(tonnages, kind='stable')
+    
+    # One stable sort by (customer, tonnage), split at customer boundaries
+    codes, names = pd.factorize(orders_db['CustomerName'].astype(str))
+    by_customer = np.lexsort((tonnages, codes))
+    boundaries = np.flatnonzero(np.diff(codes[by_customer])) + 1
+    customers = {}
+    for group in np.split(by_customer, boundaries):
+        if len(group) > 0:
+            customers[names[codes[group[0]]]] = (group, tonnages[group])
+    
+    scaler = None
+    if len(orders_db) > 0:
+        scaler = StandardScaler().fit(orders_db[['L', 'a', 'b']].values.astype(float))
+    
+    return {
+        'orders': orders_db,
+        'positions': positions,
+        'tonnages': tonnages[positions],
+        'customers': customers,
+        'scaler': scaler
+    }
+
+
+def parse_order_filters(data):
+    """
+    Read order filters from a request body.
+    
+    Args:
+        data: Request body with optional 'customers' (name or list of names)
+            and 'minTonnage' (minimum RequiredTonnage)
+    
+    Returns:
+        Dictionary of filters, or None when no filter is set
+    
+    Raises:
+        ValueError: If a filter value is malformed
+    """
+    customers = data.get('customers')
+    min_tonnage = data.get('minTonnage')
+    
+    if customers is None and min_tonnage is None:
+        return None
+    
+    if isinstance(customers, str):
+        customers = [customers]
+    if customers is not None and not isinstance(customers, list):
+        raise ValueError('customers must be a name or a list of names')
+    
+    if min_tonnage is not None:
+        try:
+            min_tonnage = float(min_tonnage)
+        except (TypeError, ValueError):
+            raise ValueError('minTonnage must be a number')
+    
+    return {
+        # Drop repeated names so their rows are not selected twice
+        'customers': list(dict.fromkeys(str(name) for name in customers)) if customers is not None else None,
+        'minTonnage': min_tonnage
+    }
+
+
+def filter_orders(filters):
+    """
+    Select the orders matching the filters using the order sub-indexes.
+    
+    Cost is proportional to the number of matching orders rather than the
+    size of the table.
+    
+    Returns:
+        Tuple of (orders DataFrame restricted to matching rows in table order,
+        KNN scaler fitted on the full table)
+    """
+    # Read once: the table and its indexes must come from the same snapshot
+    index = order_index
+    
+    if filters is None:
+        return index['orders'], index['scaler']
+    
+    if filters['customers'] is None:
+        slices = [(index['positions'], index['tonnages'])]
+    else:
+        slices = [index['customers'][name] for name in filters['customers'] if name in index['customers']]
+    
+    selected = []
+    for positions, tonnages in slices:
+        if filters['minTonnage'] is not None:
+            positions = positions[np.searchsorted(tonnages, filters['minTonnage'], side='left'):]
+        selected.append(positions)
+    
+    positions = np.sort(np.concatenate(selected)) if selected else np.empty(0, dtype=np.int64)
+    return index['orders'].iloc[positions], index['scaler']
+
+
 def load_default_databases():
     """Load default databases."""
     possible_pigment_files = ['pigments.xlsx', 'uploads/pigments.xlsx']
@@ -259,14 +556,15 @@ def load_default_databases():
     for pigment_file in possible_pigment_files:
         if os.path.exists(pigment_file):
             try:
-                databases['pigments'] = pd.read_excel(pigment_file)
-                if 'PigmentID' not in databases['pigments'].columns:
-                    databases['pigments']['PigmentID'] = [f'PIG-{str(i+1).zfill(4)}' for i in range(len(databases['pigments']))]
-                if 'HexColor' not in databases['pigments'].columns:
-                    databases['pigments']['HexColor'] = databases['pigments'].apply(
+                df = pd.read_excel(pigment_file)
+                if 'PigmentID' not in df.columns:
+                    df['PigmentID'] = [f'PIG-{str(i+1).zfill(4)}' for i in range(len(df))]
+                if 'HexColor' not in df.columns:
+                    df['HexColor'] = df.apply(
                         lambda row: lab_to_hex(row['L'], row['a'], row['b']), axis=1
                     )
-                print(f"Loaded pigment database: {len(databases['pigments'])} records")
+                set_database('pigments', df)
+                print(f"Loaded pigment database: {len(df)} records")
                 pigment_loaded = True
                 break
             except Exception as e:
@@ -274,19 +572,24 @@ def load_default_databases():
     
     if not pigment_loaded:
         print("Generating sample pigment database")
-        databases['pigments'] = generate_sample_pigments()
+        set_database('pigments', generate_sample_pigments())
     
     # Load orders database
     orders_loaded = False
     for orders_file in possible_order_files:
         if os.path.exists(orders_file):
             try:
-                databases['orders'] = pd.read_excel(orders_file)
-                if 'HexColor' not in databases['orders'].columns:
-                    databases['orders']['HexColor'] = databases['orders'].apply(
+                df = pd.read_excel(orders_file)
+                if 'OrderID' not in df.columns:
+                    df['OrderID'] = [f'ORD-2024-{str(i+1).zfill(4)}' for i in range(len(df))]
+                if 'CustomerName' not in df.columns:
+                    df['CustomerName'] = 'Unknown Customer'
+                if 'HexColor' not in df.columns:
+                    df['HexColor'] = df.apply(
                         lambda row: lab_to_hex(row['L'], row['a'], row['b']), axis=1
                     )
-                print(f"Loaded orders database: {len(databases['orders'])} records")
+                set_database('orders', df)
+                print(f"Loaded orders database: {len(df)} records")
                 orders_loaded = True
                 break
             except Exception as e:
@@ -294,7 +597,7 @@ def load_default_databases():
     
     if not orders_loaded:
         print("Generating sample orders database")
-        databases['orders'] = generate_sample_orders()
+        set_database('orders', generate_sample_orders())
 
 
 # Load databases on startup
@@ -329,11 +632,18 @@ def logout():
 @app.route('/api/database/pigments', methods=['GET'])
 def get_pigments():
     """Get pigment database."""
-    if databases['pigments'] is not None:
+    # Snapshot the table and its version together; uploads replace, never mutate
+    with dataset_lock:
+        df = databases['pigments']
+        version = dataset_state['version']
+    
+    if df is not None:
         return jsonify({
             'success': True,
-            'data': databases['pigments'].to_dict('records'),
-            'count': len(databases['pigments'])
+            'data': df.to_dict('records'),
+            'count': len(df),
+            'version': version,
+            'epoch': dataset_epoch()
         })
     return jsonify({'success': False, 'message': 'No database loaded'}), 404
 
@@ -341,15 +651,92 @@ def get_pigments():
 @app.route('/api/database/orders', methods=['GET'])
 def get_orders():
     """Get orders database."""
-    if databases['orders'] is not None:
+    # Snapshot the table and its version together; uploads replace, never mutate
+    with dataset_lock:
+        df = databases['orders']
+        version = dataset_state['version']
+    
+    if df is not None:
         return jsonify({
             'success': True,
-            'data': databases['orders'].to_dict('records'),
-            'count': len(databases['orders'])
+            'data': df.to_dict('records'),
+            'count': len(df),
+            'version': version,
+            'epoch': dataset_epoch()
         })
     return jsonify({'success': False, 'message': 'No orders loaded'}), 404
 
 
+@app.route('/api/database/changes', methods=['GET'])
+def get_database_changes():
+    """
+    Get rows inserted, updated or deleted since a dataset version.
+    
+    Query parameters:
+        since: Dataset version the client last synced to
+        epoch: Epoch returned alongside that version
+        table: Optional 'pigments' or 'orders'; defaults to both
+    
+    A table is flagged with fullReload when its change log no longer reaches
+    back to 'since', or when 'epoch' is missing or differs from this process's
+    (the server restarted, or the request reached a different worker).
+    """
+    since = request.args.get('since', type=int)
+    if since is None:
+        return jsonify({'success': False, 'message': 'Missing or invalid since version'}), 400
+    
+    table = request.args.get('table')
+    if table is not None and table not in TABLE_ID_COLUMNS:
+        return jsonify({'success': False, 'message': f'Unknown table: {table}'}), 400
+    tables = [table] if table else list(TABLE_ID_COLUMNS)
+    same_epoch = request.args.get('epoch') == dataset_epoch()
+    
+    with dataset_lock:
+        version = dataset_state['version']
+        snapshot = {}
+        for name in tables:
+            if not same_epoch or since < dataset_state['floor'][name] or since > version:
+                snapshot[name] = None
+            else:
+                snapshot[name] = [entry for entry in dataset_state['changes'][name] if entry[0] > since]
+    
+    changes = {}
+    for name, entries in snapshot.items():
+        if entries is None:
+            changes[name] = {'fullReload': True, 'inserted': [], 'updated': [], 'deleted': []}
+            continue
+        
+        # Collapse to the net effect per row: first op tells whether the client
+        # has seen the row, the last entry gives its current state
+        net = {}
+        for _, op, row_id, row in entries:
+            if row_id in net:
+                net[row_id] = (net[row_id][0], op, row)
+            else:
+                net[row_id] = (op, op, row)
+        
+        inserted, updated, deleted = [], [], []
+        for row_id, (first_op, last_op, row) in net.items():
+            if last_op == 'delete':
+                if first_op != 'insert':
+                    deleted.append(row_id)
+            elif first_op == 'insert':
+                inserted.append(row)
+            else:
+                updated.append(row)
+        
+        changes[name] = {'fullReload': False, 'inserted': inserted, 'updated': updated, 'deleted': deleted}
+    
+    return jsonify({
+        'success': True,
+        'since': since,
+        'version': version,
+        'epoch': dataset_epoch(),
+        'fullReload': any(c['fullReload'] for c in changes.values()),
+        'changes': changes
+    })
+
+
 @app.route('/api/database/upload/pigments', methods=['POST'])
 def upload_pigments():
     """Upload pigment database."""
@@ -373,9 +760,9 @@ def upload_pigments():
                 df['PigmentID'] = [f'PIG-{str(i+1).zfill(4)}' for i in range(len(df))]
             
             df['HexColor'] = df.apply(lambda row: lab_to_hex(row['L'], row['a'], row['b']), axis=1)
-            databases['pigments'] = df
+            version = set_database('pigments', df)
             
-            return jsonify({'success': True, 'count': len(df)})
+            return jsonify({'success': True, 'count': len(df), 'version': version, 'epoch': dataset_epoch()})
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 400
     
@@ -407,9 +794,9 @@ def upload_orders():
                 df['CustomerName'] = 'Unknown Customer'
             
             df['HexColor'] = df.apply(lambda row: lab_to_hex(row['L'], row['a'], row['b']), axis=1)
-            databases['orders'] = df
+            version = set_database('orders', df)
             
-            return jsonify({'success': True, 'count': len(df)})
+            return jsonify({'success': True, 'count': len(df), 'version': version, 'epoch': dataset_epoch()})
         except Exception as e:
             return jsonify({'success': False, 'message': str(e)}), 400
     
@@ -418,26 +805,75 @@ def upload_orders():
 
 @app.route('/api/match/pigment-to-orders', methods=['POST'])
 def match_pigment_to_orders():
-    """Find the 3 closest customer orders for a selected pigment."""
+    """
+    Find the 3 closest customer orders for a selected pigment.
+    
+    Optional 'customers' and 'minTonnage' in the request body restrict the
+    search to matching orders, so the top 3 are the best filtered matches.
+    """
     data = request.json
     pigment_id = data.get('pigmentId')
     
     if databases['pigments'] is None or databases['orders'] is None:
         return jsonify({'success': False, 'message': 'Databases not loaded'}), 404
     
+    try:
+        filters = parse_order_filters(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    orders_db, scaler = filter_orders(filters)
+    if len(orders_db) == 0:
+        return jsonify({'success': False, 'message': 'No orders match the filters'}), 404
+    
     # Get the selected pigment
     pigment = databases['pigments'][databases['pigments']['PigmentID'] == pigment_id]
     if len(pigment) == 0:
         return jsonify({'success': False, 'message': 'Pigment not found'}), 404
     
     pigment_data = pigment.iloc[0]
+    result = compute_pigment_match(pigment_data, orders_db, scaler)
+    
+    return jsonify({
+        'success': True,
+        'pigment': {
+            'id': pigment_data['PigmentID'],
+            'L': float(pigment_data['L']),
+            'a': float(pigment_data['a']),
+            'b': float(pigment_data['b']),
+            'hex': pigment_data['HexColor'],
+            'availableTonnage': float(pigment_data['AvailableTonnage'])
+        },
+        'euclidean': result['euclidean'],
+        'cosine': result['cosine'],
+        'knn': result['knn'],
+        'consensus': result['consensus'],
+        'productionRecommendation': result['productionRecommendation'],
+        'filters': filters,
+        'searchedOrders': len(orders_db)
+    })
+
+
+def compute_pigment_match(pigment_data, orders_db, scaler=None):
+    """
+    Run the full matching pipeline for one pigment.
+    
+    Args:
+        pigment_data: Pigment row (Series) with L, a, b and AvailableTonnage
+        orders_db: Orders to search, possibly already filtered
+        scaler: Optional KNN scaler fitted on the full orders table
+    
+    Returns:
+        Dictionary with euclidean, cosine, knn and consensus match lists and
+        the productionRecommendation
+    """
     pigment_lab = [float(pigment_data['L']), float(pigment_data['a']), float(pigment_data['b'])]
     available_tonnage = float(pigment_data['AvailableTonnage'])
     
     # Calculate matches using all three methods
-    euclidean_matches = calculate_euclidean_matches(pigment_lab, databases['orders'])
-    cosine_matches = calculate_cosine_matches(pigment_lab, databases['orders'])
-    knn_matches = calculate_knn_matches(pigment_lab, databases['orders'])
+    euclidean_matches = calculate_euclidean_matches(pigment_lab, orders_db)
+    cosine_matches = calculate_cosine_matches(pigment_lab, orders_db)
+    knn_matches = calculate_knn_matches(pigment_lab, orders_db, scaler=scaler)
     
     # Assign priority only for true tie-breaker situations
     euclidean_matches = assign_priority_for_close_matches(euclidean_matches, delta_e_key='deltaE')
@@ -454,22 +890,13 @@ def match_pigment_to_orders():
         available_tonnage
     )
     
-    return jsonify({
-        'success': True,
-        'pigment': {
-            'id': pigment_data['PigmentID'],
-            'L': float(pigment_data['L']),
-            'a': float(pigment_data['a']),
-            'b': float(pigment_data['b']),
-            'hex': pigment_data['HexColor'],
-            'availableTonnage': available_tonnage
-        },
+    return {
         'euclidean': euclidean_matches,
         'cosine': cosine_matches,
         'knn': knn_matches,
         'consensus': consensus,
         'productionRecommendation': production_recommendation
-    })
+    }
 
 
 def calculate_euclidean_matches(pigment_lab, orders_db, n_matches=3):
@@ -542,13 +969,19 @@ def calculate_cosine_matches(pigment_lab, orders_db, n_matches=3):
     return results
 
 
-def calculate_knn_matches(pigment_lab, orders_db, n_matches=3):
-    """Calculate KNN matches from pigment to orders."""
+def calculate_knn_matches(pigment_lab, orders_db, n_matches=3, scaler=None):
+    """
+    Calculate KNN matches from pigment to orders.
+    
+    A pre-fitted scaler can be passed to normalise with statistics from a
+    larger table than orders_db (e.g. the full table when orders_db is filtered).
+    """
     order_values = orders_db[['L', 'a', 'b']].values.astype(float)
     pigment_array = np.array(pigment_lab).reshape(1, -1)
     
-    scaler = StandardScaler()
-    orders_scaled = scaler.fit_transform(order_values)
+    if scaler is None:
+        scaler = StandardScaler().fit(order_values)
+    orders_scaled = scaler.transform(order_values)
     pigment_scaled = scaler.transform(pigment_array)
     
     n_neighbors = min(n_matches, len(orders_db))
@@ -777,6 +1210,624 @@ def generate_production_recommendation(pigment, top_orders, available_tonnage):
     }
 
 
+@app.route('/api/tuning/threshold-sweep', methods=['POST'])
+def threshold_sweep():
+    """
+    Evaluate a grid of priority threshold pairs across all pigments.
+    
+    Request body (all optional):
+        maxDeltaEValues: Candidate values for DELTA_E_MAX_FOR_PRIORITY
+        tieThresholdValues: Candidate values for DELTA_E_TIE_THRESHOLD
+        customers, minTonnage: Order filters, as for the match endpoint
+    
+    Match candidates are computed once per pigment; each grid point only
+    re-scores the priority tie-breaks, vectorised over every match list.
+    """
+    data = request.json or {}
+    
+    if databases['pigments'] is None or databases['orders'] is None:
+        return jsonify({'success': False, 'message': 'Databases not loaded'}), 404
+    
+    try:
+        max_values = [float(v) for v in data.get('maxDeltaEValues', SWEEP_DEFAULT_MAX_DELTA_E)]
+        tie_values = [float(v) for v in data.get('tieThresholdValues', SWEEP_DEFAULT_TIE_THRESHOLD)]
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Threshold values must be lists of numbers'}), 400
+    if not max_values or not tie_values:
+        return jsonify({'success': False, 'message': 'Threshold value lists must not be empty'}), 400
+    
+    try:
+        filters = parse_order_filters(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    orders_db, scaler = filter_orders(filters)
+    if len(orders_db) == 0:
+        return jsonify({'success': False, 'message': 'No orders match the filters'}), 404
+    
+    candidates = collect_priority_candidates(databases['pigments'], orders_db, scaler)
+    
+    current = score_threshold_pair(candidates, DELTA_E_MAX_FOR_PRIORITY, DELTA_E_TIE_THRESHOLD)
+    
+    results = []
+    for max_delta_e in max_values:
+        for tie_threshold in tie_values:
+            scored = score_threshold_pair(candidates, max_delta_e, tie_threshold)
+            result = scored['summary']
+            result['changes'] = {
+                'priorityTags': {
+                    method: result['priorityTags'][method] - current['summary']['priorityTags'][method]
+                    for method in PRIORITY_METHODS
+                },
+                'priorityRequired': round(result['priorityRequired'] - current['summary']['priorityRequired'], 2),
+                'pigmentsChanged': int(np.any(
+                    scored['consensusPriority'] != current['consensusPriority'], axis=1
+                ).sum())
+            }
+            results.append(result)
+    
+    return jsonify({
+        'success': True,
+        'pigmentCount': len(databases['pigments']),
+        'filters': filters,
+        'current': current['summary'],
+        'grid': results
+    })
+
+
+def collect_priority_candidates(pigments_db, orders_db, scaler=None):
+    """
+    Run the matching pipeline once per pigment and keep what priority scoring needs.
+    
+    Returns:
+        Dictionary with, per method, (n_pigments, n_matches) arrays of the Delta E
+        used for tie-breaks ('deltas', inf where missing) and required tonnage
+        ('tonnages'), plus per-pigment production totals, which only depend on
+        which orders are matched and not on the priority thresholds.
+    """
+    lists = {method: [] for method in PRIORITY_METHODS}
+    total_required = 0.0
+    total_shortage = 0.0
+    total_production = 0.0
+    
+    for _, pigment_data in pigments_db.iterrows():
+        pigment_lab = [float(pigment_data['L']), float(pigment_data['a']), float(pigment_data['b'])]
+        
+        euclidean_matches = calculate_euclidean_matches(pigment_lab, orders_db)
+        cosine_matches = calculate_cosine_matches(pigment_lab, orders_db)
+        knn_matches = calculate_knn_matches(pigment_lab, orders_db, scaler=scaler)
+        consensus = analyze_consensus(euclidean_matches, cosine_matches, knn_matches)
+        
+        lists['euclidean'].append([(m['deltaE'], m['requiredTonnage']) for m in euclidean_matches])
+        lists['cosine'].append([(m['euclideanDistance'], m['requiredTonnage']) for m in cosine_matches])
+        lists['knn'].append([(m['rawDistance'], m['requiredTonnage']) for m in knn_matches])
+        # Same Delta E fallback as analyze_consensus
+        lists['consensus'].append([
+            (m.get('euclideanDeltaE') or float('inf'), m['requiredTonnage']) for m in consensus
+        ])
+        
+        recommendation = generate_production_recommendation(
+            pigment_data.to_dict(),
+            consensus[:3],
+            float(pigment_data['AvailableTonnage'])
+        )
+        total_required += recommendation['totalRequired']
+        total_shortage += recommendation['shortage']
+        total_production += recommendation['productionRecommendation']
+    
+    candidates = {
+        'totalRequired': total_required,
+        'shortage': total_shortage,
+        'productionRecommendation': total_production
+    }
+    for method, method_lists in lists.items():
+        width = max((len(items) for items in method_lists), default=0)
+        deltas = np.full((len(method_lists), width), np.inf)
+        tonnages = np.zeros((len(method_lists), width))
+        for row, items in enumerate(method_lists):
+            for col, (delta_e, tonnage) in enumerate(items):
+                deltas[row, col] = delta_e
+                tonnages[row, col] = tonnage
+        candidates[method] = {'deltas': deltas, 'tonnages': tonnages}
+    
+    return candidates
+
+
+def score_threshold_pair(candidates, max_delta_e, tie_threshold):
+    """Score one threshold pair against precomputed candidates."""
+    priority = {
+        method: assign_priority_vectorized(
+            candidates[method]['deltas'], candidates[method]['tonnages'], max_delta_e, tie_threshold
+        )
+        for method in PRIORITY_METHODS
+    }
+    
+    # Production recommendations only look at the top 3 consensus orders
+    consensus_top = priority['consensus'][:, :3]
+    priority_required = float(np.sum(candidates['consensus']['tonnages'][:, :3] * consensus_top))
+    
+    summary = {
+        'maxDeltaE': max_delta_e,
+        'tieThreshold': tie_threshold,
+        'priorityTags': {method: int(mask.sum()) for method, mask in priority.items()},
+        'pigmentsWithPriority': int(np.any(consensus_top, axis=1).sum()),
+        'priorityRequired': round(priority_required, 2),
+        'totalRequired': round(candidates['totalRequired'], 2),
+        'totalShortage': round(candidates['shortage'], 2),
+        'totalProductionRecommendation': round(candidates['productionRecommendation'], 2)
+    }
+    
+    return {'summary': summary, 'consensusPriority': priority['consensus']}
+
+
+def assign_priority_vectorized(deltas, tonnages, max_delta_e, tie_threshold):
+    """
+    Vectorised assign_priority_for_close_matches over many match lists.
+    
+    Args:
+        deltas: (n_lists, n_matches) Delta E per match, inf where missing
+        tonnages: (n_lists, n_matches) required tonnage per match
+        max_delta_e: Only matches below this Delta E can take priority
+        tie_threshold: Maximum Delta E spread within a tie group
+    
+    Returns:
+        (n_lists, n_matches) boolean array, True where the match gets 'Priority'
+    """
+    n_lists, n_matches = deltas.shape
+    priority = np.zeros((n_lists, n_matches), dtype=bool)
+    
+    good = deltas < max_delta_e
+    good &= (good.sum(axis=1) >= 2)[:, None]
+    used = np.zeros_like(good)
+    positions = np.arange(n_matches)
+    
+    # Same greedy pass as the scalar version: each unused good match opens a
+    # group with the later good matches within tie_threshold of it
+    for i in range(n_matches):
+        opens = good[:, i] & ~used[:, i]
+        
+        with np.errstate(invalid='ignore'):
+            close = np.abs(deltas - deltas[:, i:i + 1]) <= tie_threshold
+            members = good & ~used & close & (positions > i)
+            members[:, i] = True
+            
+            # All members pairwise within threshold <=> spread within threshold
+            spread = np.where(members, deltas, -np.inf).max(axis=1) - np.where(members, deltas, np.inf).min(axis=1)
+        is_group = opens & (members.sum(axis=1) > 1) & (spread <= tie_threshold)
+        members &= is_group[:, None]
+        used |= members
+        
+        # Highest tonnage wins, only if strictly above the runner-up
+        group_tonnage = np.where(members, tonnages, -np.inf)
+        top = group_tonnage == group_tonnage.max(axis=1, keepdims=True)
+        winner = is_group & ((top & members).sum(axis=1) == 1)
+        priority[winner, np.argmax(top & members, axis=1)[winner]] = True
+    
+    return priority
+
+
+@app.route('/api/viz/pointcloud', methods=['GET'])
+def get_point_cloud():
+    """
+    Get a voxel-downsampled L*a*b* point cloud of pigments and orders.
+    
+    Query parameters:
+        level: Detail level 0..VIZ_MAX_LEVEL; voxel size halves with each level
+        lMin, lMax, aMin, aMax, bMin, bMax: Optional viewport bounds
+        pigmentId: Selected pigment; points near it are sent unaggregated
+        radius: Delta E radius around the selected pigment (default VIZ_EXACT_RADIUS,
+            at most VIZ_MAX_RADIUS). Only the VIZ_MAX_EXACT_POINTS nearest points
+            inside it are sent unaggregated; the rest are voxelized as usual.
+    
+    Returns:
+        Binary payload: uint32 header length, JSON header, then 4-byte aligned
+        buffers described by the header's 'buffers' list.
+    """
+    # Snapshot both tables so an upload mid-request cannot mix versions
+    with dataset_lock:
+        pigments_db = databases['pigments']
+        orders_db = databases['orders']
+    
+    if pigments_db is None or orders_db is None:
+        return jsonify({'success': False, 'message': 'Databases not loaded'}), 404
+    
+    level = request.args.get('level', VIZ_DEFAULT_LEVEL, type=int)
+    level = max(0, min(VIZ_MAX_LEVEL, level))
+    voxel_size = VIZ_BASE_VOXEL_SIZE / (2 ** level)
+    radius = request.args.get('radius', VIZ_EXACT_RADIUS, type=float)
+    radius = max(0.0, min(VIZ_MAX_RADIUS, radius))
+    
+    bounds = []
+    for axis in ('l', 'a', 'b'):
+        low = request.args.get(f'{axis}Min', -np.inf, type=float)
+        high = request.args.get(f'{axis}Max', np.inf, type=float)
+        bounds.append((low, high))
+    
+    center = None
+    pigment_id = request.args.get('pigmentId')
+    if pigment_id:
+        pigment = pigments_db[pigments_db['PigmentID'] == pigment_id]
+        if len(pigment) == 0:
+            return jsonify({'success': False, 'message': 'Pigment not found'}), 404
+        center = pigment.iloc[0][['L', 'a', 'b']].values.astype(float)
+    
+    sources = [
+        (0, pigments_db, 'PigmentID', 'AvailableTonnage'),
+        (1, orders_db, 'OrderID', 'RequiredTonnage')
+    ]
+    
+    # Distance to the selected pigment, inf outside the radius
+    distances = []
+    for kind, df, id_col, tonnage_col in sources:
+        if center is None:
+            distances.append(np.full(len(df), np.inf))
+        else:
+            lab = df[['L', 'a', 'b']].values.astype(float)
+            distance = np.sqrt(np.sum((lab - center) ** 2, axis=1))
+            distances.append(np.where(distance <= radius, distance, np.inf))
+    
+    # Keep only the nearest VIZ_MAX_EXACT_POINTS across both tables
+    combined = np.concatenate(distances)
+    in_radius = int(np.isfinite(combined).sum())
+    if in_radius > VIZ_MAX_EXACT_POINTS:
+        keep = np.zeros(len(combined), dtype=bool)
+        keep[np.argsort(combined, kind='stable')[:VIZ_MAX_EXACT_POINTS]] = True
+        combined = np.where(keep, combined, np.inf)
+        distances = np.split(combined, [len(pigments_db)])
+    
+    exact_parts = []
+    voxel_parts = []
+    exact_ids = []
+    for (kind, df, id_col, tonnage_col), distance in zip(sources, distances):
+        lab = df[['L', 'a', 'b']].values.astype(float)
+        tonnage = df[tonnage_col].values.astype(float)
+        
+        exact_mask = np.isfinite(distance)
+        if center is not None:
+            exact_parts.append((kind, lab[exact_mask], np.ones(exact_mask.sum()), tonnage[exact_mask]))
+            exact_ids.extend(
+                {'id': str(item_id), 'kind': kind} for item_id in df[id_col].values[exact_mask]
+            )
+        
+        in_view = ~exact_mask
+        for axis, (low, high) in enumerate(bounds):
+            in_view &= (lab[:, axis] >= low) & (lab[:, axis] <= high)
+        
+        centroids, counts, tonnage_sums = voxel_downsample(lab[in_view], tonnage[in_view], voxel_size)
+        voxel_parts.append((kind, centroids, counts, tonnage_sums))
+    
+    # Exact points come first so they line up with header['exact']
+    parts = exact_parts + voxel_parts
+    positions = np.concatenate([p[1] for p in parts]) if parts else np.empty((0, 3))
+    header = {
+        'level': level,
+        'voxelSize': voxel_size,
+        'pointCount': len(positions),
+        'exactCount': len(exact_ids),
+        'exact': exact_ids,
+        'pigmentId': pigment_id,
+        'radius': radius if center is not None else None,
+        'exactTruncated': in_radius > VIZ_MAX_EXACT_POINTS,
+        'totalPigments': len(pigments_db),
+        'totalOrders': len(orders_db)
+    }
+    buffers = [
+        ('position', 'float32', 3, positions),
+        ('count', 'float32', 1, np.concatenate([p[2] for p in parts])),
+        ('tonnage', 'float32', 1, np.concatenate([p[3] for p in parts])),
+        ('color', 'uint8', 3, lab_to_rgb_array(positions)),
+        ('kind', 'uint8', 1, np.concatenate([np.full(len(p[1]), p[0]) for p in parts])),
+        ('exact', 'uint8', 1, np.concatenate([np.full(len(p[1]), i < len(exact_parts)) for i, p in enumerate(parts)]))
+    ]
+    
+    return Response(pack_point_cloud(header, buffers), mimetype='application/octet-stream')
+
+
+def voxel_downsample(lab, tonnage, voxel_size):
+    """
+    Collapse L*a*b* points into cubic voxels.
+    
+    Args:
+        lab: (n, 3) array of L*a*b* values
+        tonnage: (n,) array of tonnage per point
+        voxel_size: Voxel edge length in Delta E units
+    
+    Returns:
+        Tuple of (voxel centroids, point counts, summed tonnage) per occupied voxel
+    """
+    if len(lab) == 0:
+        return np.empty((0, 3)), np.empty(0), np.empty(0)
+    
+    keys = np.floor(lab / voxel_size).astype(np.int64)
+    _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    
+    centroids = np.column_stack([
+        np.bincount(inverse, weights=lab[:, axis], minlength=len(counts)) for axis in range(3)
+    ]) / counts[:, None]
+    tonnage_sums = np.bincount(inverse, weights=tonnage, minlength=len(counts))
+    
+    return centroids, counts.astype(float), tonnage_sums
+
+
+def pack_point_cloud(header, buffers):
+    """
+    Serialise a point cloud into a compact binary payload.
+    
+    Layout: little-endian uint32 header length, UTF-8 JSON header padded to a
+    4-byte boundary, then the buffers. Each entry in header['buffers'] gives a
+    4-byte aligned offset relative to the end of the header, so the client can
+    wrap it in a typed array directly.
+    """
+    arrays = []
+    descriptors = []
+    offset = 0
+    for name, dtype, components, values in buffers:
+        data = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder('<')).tobytes()
+        descriptors.append({
+            'name': name,
+            'type': dtype,
+            'components': components,
+            'offset': offset,
+            'byteLength': len(data)
+        })
+        padding = -len(data) % 4
+        arrays.append(data + b'\0' * padding)
+        offset += len(data) + padding
+    
+    header_bytes = json.dumps(dict(header, buffers=descriptors)).encode('utf-8')
+    header_bytes += b' ' * (-len(header_bytes) % 4)
+    
+    return struct.pack('<I', len(header_bytes)) + header_bytes + b''.join(arrays)
+
+
+@app.route('/api/export/pigment-to-orders', methods=['POST'])
+def export_pigment_to_orders():
+    """
+    Export the match results for one pigment as CSV or xlsx.
+    
+    Request body: pigmentId, format ('csv' or 'xlsx'), optional order filters.
+    """
+    data = request.json or {}
+    pigment_id = data.get('pigmentId')
+    
+    prepared = prepare_export(data, [pigment_id] if pigment_id is not None else [])
+    if isinstance(prepared, tuple):
+        return prepared
+    
+    rows = match_export_rows(prepared['pigments'], prepared['orders'], prepared['scaler'])
+    return export_response(prepared['format'], f'matches_{pigment_id}', MATCH_EXPORT_COLUMNS, rows)
+
+
+@app.route('/api/export/batch', methods=['POST'])
+def export_batch():
+    """
+    Export match results for many pigments as CSV or xlsx.
+    
+    Request body: optional pigmentIds (defaults to all pigments), format,
+    optional order filters. Rows are streamed pigment by pigment.
+    """
+    data = request.json or {}
+    
+    prepared = prepare_export(data, data.get('pigmentIds'))
+    if isinstance(prepared, tuple):
+        return prepared
+    
+    rows = match_export_rows(prepared['pigments'], prepared['orders'], prepared['scaler'])
+    return export_response(prepared['format'], 'batch_matches', MATCH_EXPORT_COLUMNS, rows)
+
+
+@app.route('/api/export/cross-match', methods=['POST'])
+def export_cross_match():
+    """
+    Export every pigment-order pair as CSV or xlsx, nearest first per pigment.
+    
+    Request body: optional pigmentIds, format, order filters and maxDeltaE
+    to drop pairs further apart than that.
+    """
+    data = request.json or {}
+    
+    max_delta_e = data.get('maxDeltaE')
+    if max_delta_e is not None:
+        try:
+            max_delta_e = float(max_delta_e)
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'maxDeltaE must be a number'}), 400
+    
+    prepared = prepare_export(data, data.get('pigmentIds'))
+    if isinstance(prepared, tuple):
+        return prepared
+    
+    rows = cross_match_export_rows(prepared['pigments'], prepared['orders'], max_delta_e)
+    return export_response(prepared['format'], 'cross_matches', CROSS_MATCH_EXPORT_COLUMNS, rows)
+
+
+def prepare_export(data, pigment_ids):
+    """
+    Validate an export request before any rows are streamed.
+    
+    Args:
+        data: Request body
+        pigment_ids: Pigments to export, or None for all pigments
+    
+    Returns:
+        Dictionary with format, pigments, (filtered) orders and KNN scaler, or an error
+        response tuple to return as-is
+    """
+    export_format = data.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'success': False, 'message': f'Unsupported format: {export_format}'}), 400
+    
+    if databases['pigments'] is None or databases['orders'] is None:
+        return jsonify({'success': False, 'message': 'Databases not loaded'}), 404
+    
+    try:
+        filters = parse_order_filters(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    orders_db, scaler = filter_orders(filters)
+    if len(orders_db) == 0:
+        return jsonify({'success': False, 'message': 'No orders match the filters'}), 404
+    
+    pigments_db = databases['pigments']
+    if pigment_ids is not None:
+        if not isinstance(pigment_ids, list) or len(pigment_ids) == 0:
+            return jsonify({'success': False, 'message': 'No pigments selected'}), 400
+        if not all(isinstance(item, (str, int, float)) and not isinstance(item, bool) for item in pigment_ids):
+            return jsonify({'success': False, 'message': 'pigmentIds must be a list of IDs'}), 400
+        missing = set(pigment_ids) - set(pigments_db['PigmentID'])
+        if missing:
+            return jsonify({
+                'success': False,
+                'message': f'Pigment not found: {", ".join(sorted(map(str, missing)))}'
+            }), 404
+        pigments_db = pigments_db[pigments_db['PigmentID'].isin(pigment_ids)]
+    
+    return {'format': export_format, 'pigments': pigments_db, 'orders': orders_db, 'scaler': scaler}
+
+
+def match_export_rows(pigments_db, orders_db, scaler=None):
+    """Yield one row per match and method, computing each pigment's matches lazily."""
+    for _, pigment_data in pigments_db.iterrows():
+        result = compute_pigment_match(pigment_data, orders_db, scaler)
+        pigment_id = pigment_data['PigmentID']
+        recommendation = result['productionRecommendation']
+        fulfillment = {
+            detail['orderId']: detail for detail in recommendation['fulfillmentDetails']
+        }
+        summary = [
+            recommendation['availableTonnage'],
+            recommendation['status'],
+            recommendation['totalRequired'],
+            recommendation['shortage'],
+            recommendation['productionRecommendation'],
+            recommendation['priorityRequired']
+        ]
+        
+        for method, delta_e_key, score_key in MATCH_EXPORT_METHODS:
+            for rank, match in enumerate(result[method], 1):
+                detail = fulfillment.get(match['orderId']) if method == 'consensus' else None
+                yield [
+                    pigment_id,
+                    method,
+                    match.get('rank', rank),
+                    match['orderId'],
+                    match['customerName'],
+                    match['L'],
+                    match['a'],
+                    match['b'],
+                    match['requiredTonnage'],
+                    match.get(delta_e_key),
+                    match.get(score_key),
+                    match.get('interpretation'),
+                    match.get('priority'),
+                    detail['status'] if detail else None,
+                    detail['canFulfill'] if detail else None
+                ] + summary
+
+
+def cross_match_export_rows(pigments_db, orders_db, max_delta_e=None):
+    """Yield every pigment-order pair within max_delta_e, nearest first per pigment."""
+    order_values = orders_db[['L', 'a', 'b']].values.astype(float)
+    order_ids = orders_db['OrderID'].astype(str).values
+    customer_names = orders_db['CustomerName'].astype(str).values
+    required = orders_db['RequiredTonnage'].values.astype(float)
+    
+    for _, pigment_data in pigments_db.iterrows():
+        pigment_array = np.array([float(pigment_data['L']), float(pigment_data['a']), float(pigment_data['b'])])
+        distances = np.sqrt(np.sum((order_values - pigment_array) ** 2, axis=1))
+        
+        indices = np.argsort(distances, kind='stable')
+        if max_delta_e is not None:
+            indices = indices[distances[indices] <= max_delta_e]
+        
+        pigment_id = pigment_data['PigmentID']
+        available = float(pigment_data['AvailableTonnage'])
+        for rank, idx in enumerate(indices, 1):
+            yield [
+                pigment_id,
+                rank,
+                order_ids[idx],
+                customer_names[idx],
+                round(float(distances[idx]), 3),
+                available,
+                float(required[idx])
+            ]
+
+
+def export_response(export_format, name, columns, rows):
+    """Stream rows to the client as a CSV or xlsx attachment."""
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    generate = stream_csv if export_format == 'csv' else stream_xlsx
+    
+    # name may contain uploaded IDs: send an ASCII-safe fallback plus the
+    # RFC 5987 encoded original
+    filename = f'{name}.{extension}'
+    fallback = secure_filename(filename) or f'export.{extension}'
+    disposition = f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+    
+    return Response(
+        stream_with_context(generate(columns, rows)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': disposition}
+    )
+
+
+def stream_csv(columns, rows):
+    """Yield CSV text in chunks of about EXPORT_CHUNK_SIZE, header first."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def stream_xlsx(columns, rows):
+    """
+    Yield an xlsx workbook built with openpyxl's write-only mode.
+    
+    Rows are flushed to a temporary file as they are written, so memory stays
+    flat. The zip container is only complete once every row is written, so
+    bytes start flowing after the last row rather than the first. Sheets roll
+    over at Excel's row limit.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = None
+    sheet_rows = EXCEL_MAX_ROWS
+    
+    for row in rows:
+        if sheet_rows >= EXCEL_MAX_ROWS:
+            sheet = workbook.create_sheet(f'Results {len(workbook.worksheets) + 1}')
+            sheet.append(columns)
+            sheet_rows = 1
+        sheet.append(row)
+        sheet_rows += 1
+    
+    if sheet is None:
+        workbook.create_sheet('Results 1').append(columns)
+    
+    with tempfile.TemporaryFile() as output:
+        workbook.save(output)
+        output.seek(0)
+        while True:
+            chunk = output.read(EXPORT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
 if __name__ == '__main__':
     print("=" * 50)
     print("Pigment-to-Order Matcher API")
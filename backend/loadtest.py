@@ -0,0 +1,518 @@
+"""
+Load-test harness for the Pigment-to-Order Matcher API
+Runs the app under gunicorn and measures throughput, tail latency and memory
+
+Usage:
+    python loadtest.py --workers 4 --threads 2 --pigments 5000 --orders 20000 \
+        --clients 32 --duration 30 --mix match=8,pigments=1,orders=1 --output run.json
+    python loadtest.py --compare baseline.json run.json
+
+The server runs with --preload. A gunicorn when_ready hook posts the synthetic
+datasets through the upload endpoints in the master process before workers are
+forked, so every worker serves the same seeded tables.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+import numpy as np
+import pandas as pd
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Request kinds the mix can draw from, see build_request()
+REQUEST_KINDS = ['match', 'match_filtered', 'pigments', 'orders', 'changes']
+# Default request mix: relative weights per request kind
+DEFAULT_MIX = 'match=8,pigments=1,orders=1'
+
+CUSTOMER_NAMES = ['Acme Corp', 'Global Industries', 'Tech Solutions', 'Prime Manufacturing',
+                  'Elite Products', 'Quality Goods', 'Master Coatings', 'Supreme Paints',
+                  'ColorMax', 'PigmentPro', 'Industrial Colors', 'Custom Shades']
+
+# Metrics compared by --compare, with True where higher is better
+COMPARED_METRICS = {
+    'requestsPerSecond': True,
+    'p50Ms': False,
+    'p95Ms': False,
+    'p99Ms': False,
+    'errors': False
+}
+
+GUNICORN_CONFIG = '''
+import json
+import os
+import time
+
+
+def when_ready(server):
+    """Seed the preloaded app through its upload endpoints before workers fork."""
+    from app import app
+
+    client = app.test_client()
+    report = {}
+    for table in ('pigments', 'orders'):
+        path = os.environ['LOADTEST_SEED_' + table.upper()]
+        started = time.time()
+        with open(path, 'rb') as f:
+            response = client.post(
+                f'/api/database/upload/{table}',
+                data={'file': (f, os.path.basename(path))},
+                content_type='multipart/form-data'
+            )
+        report[table] = {
+            'status': response.status_code,
+            'body': response.get_json(),
+            'seconds': round(time.time() - started, 2)
+        }
+
+    with open(os.environ['LOADTEST_SEED_REPORT'], 'w') as f:
+        json.dump(report, f)
+'''
+
+
+def generate_pigments(n, seed):
+    """Generate a synthetic pigment table with the upload endpoint's columns."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'PigmentID': [f'PIG-{str(i+1).zfill(6)}' for i in range(n)],
+        'L': np.round(rng.uniform(20, 95, n), 2),
+        'a': np.round(rng.uniform(-60, 60, n), 2),
+        'b': np.round(rng.uniform(-60, 60, n), 2),
+        'AvailableTonnage': np.round(rng.uniform(5, 100, n), 2)
+    })
+
+
+def generate_orders(n, seed):
+    """Generate a synthetic order table with the upload endpoint's columns."""
+    rng = np.random.default_rng(seed + 1)
+    return pd.DataFrame({
+        'OrderID': [f'ORD-LT-{str(i+1).zfill(7)}' for i in range(n)],
+        'CustomerName': rng.choice(CUSTOMER_NAMES, n),
+        'L': np.round(rng.uniform(25, 90, n), 2),
+        'a': np.round(rng.uniform(-50, 50, n), 2),
+        'b': np.round(rng.uniform(-50, 50, n), 2),
+        'RequiredTonnage': np.round(rng.uniform(2, 40, n), 2)
+    })
+
+
+def parse_mix(mix):
+    """Parse 'kind=weight,...' into a dict, rejecting unknown request kinds."""
+    weights = {}
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise ValueError(f'Unknown request kind: {kind} (expected one of {", ".join(REQUEST_KINDS)})')
+        weights[kind] = float(weight) if weight else 1.0
+    return weights
+
+
+def build_request(kind, rng, dataset):
+    """
+    Return (method, path, body) for one request of the given kind.
+
+    dataset holds the seeded 'pigmentIds' and the 'version' and 'epoch' after
+    seeding, so 'changes' requests measure steady-state delta sync (no churn)
+    rather than a replay of the seed uploads.
+    """
+    pigment_ids = dataset['pigmentIds']
+    if kind == 'match':
+        return 'POST', '/api/match/pigment-to-orders', {'pigmentId': rng.choice(pigment_ids)}
+    if kind == 'match_filtered':
+        body = {'pigmentId': rng.choice(pigment_ids), 'customers': rng.sample(CUSTOMER_NAMES, 2), 'minTonnage': 10}
+        return 'POST', '/api/match/pigment-to-orders', body
+    if kind == 'pigments':
+        return 'GET', '/api/database/pigments', None
+    if kind == 'orders':
+        return 'GET', '/api/database/orders', None
+    if kind == 'changes':
+        query = urlencode({'since': dataset['version'], 'epoch': dataset['epoch']})
+        return 'GET', f'/api/database/changes?{query}', None
+    raise ValueError(f'Unknown request kind: {kind}')
+
+
+def free_port():
+    """Ask the OS for an unused local TCP port."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, workdir, port, pigments_path, orders_path):
+    """Start gunicorn with the seeding hook and wait until it serves requests."""
+    config_path = os.path.join(workdir, 'gunicorn_loadtest.py')
+    with open(config_path, 'w') as f:
+        f.write(GUNICORN_CONFIG)
+
+    seed_report = os.path.join(workdir, 'seed_report.json')
+    env = dict(
+        os.environ,
+        LOADTEST_SEED_PIGMENTS=pigments_path,
+        LOADTEST_SEED_ORDERS=orders_path,
+        LOADTEST_SEED_REPORT=seed_report
+    )
+    command = [
+        sys.executable, '-m', 'gunicorn',
+        '--config', config_path,
+        '--pythonpath', BACKEND_DIR,
+        '--workers', str(args.workers),
+        '--threads', str(args.threads),
+        '--bind', f'127.0.0.1:{port}',
+        '--timeout', str(args.timeout),
+        '--preload',
+        'app:app'
+    ]
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    # Run from the scratch directory so the app's default data files and
+    # upload folder do not touch the working tree
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            break
+        # Without /proc worker PIDs cannot be listed; rely on the probe alone
+        workers_up = not os.path.isdir('/proc') or len(worker_pids(process.pid)) >= args.workers
+        if os.path.exists(seed_report) and workers_up:
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+                connection.request('GET', '/api/database/changes?since=0')
+                if connection.getresponse().status == 200:
+                    with open(seed_report) as f:
+                        return process, json.load(f)
+            except OSError:
+                pass
+        time.sleep(0.5)
+
+    stop_server(process)
+    with open(os.path.join(workdir, 'gunicorn.log')) as f:
+        tail = f.read()[-2000:]
+    raise RuntimeError(f'gunicorn did not become ready:\n{tail}')
+
+
+def stop_server(process):
+    """Stop gunicorn gracefully, killing it if it does not exit."""
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def worker_pids(master_pid):
+    """Find gunicorn worker processes by parent PID (Linux /proc only)."""
+    pids = []
+    if not os.path.isdir('/proc'):
+        return pids
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # Fields after the command name, which may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == master_pid:
+            pids.append(int(entry))
+    return sorted(pids)
+
+
+def read_rss_mb(pid):
+    """Read a process's resident set size in MB, or None if unavailable."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+class RssSampler(threading.Thread):
+    """Periodically sample RSS of the gunicorn master and its workers."""
+
+    def __init__(self, master_pid, interval):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.samples = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.interval)
+
+    def sample(self):
+        for pid in [self.master_pid] + worker_pids(self.master_pid):
+            rss = read_rss_mb(pid)
+            if rss is not None:
+                self.samples.setdefault(pid, []).append(rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+    def summary(self):
+        workers = []
+        for pid, values in sorted(self.samples.items()):
+            if pid == self.master_pid:
+                continue
+            workers.append({
+                'pid': pid,
+                'rssMaxMb': round(max(values), 1),
+                'rssEndMb': round(values[-1], 1)
+            })
+        master = self.samples.get(self.master_pid, [])
+        return {
+            'masterRssMaxMb': round(max(master), 1) if master else None,
+            'workers': workers
+        }
+
+
+def run_client(client_id, port, weights, dataset, args, start_at, stop_at):
+    """Replay the request mix on one keep-alive connection until stop_at."""
+    rng = random.Random(args.seed + client_id)
+    kinds = list(weights)
+    kind_weights = [weights[kind] for kind in kinds]
+    records = []
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+
+    while time.time() < start_at:
+        time.sleep(0.001)
+
+    while time.time() < stop_at:
+        kind = rng.choices(kinds, kind_weights)[0]
+        method, path, body = build_request(kind, rng, dataset)
+        payload = json.dumps(body) if body is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+
+        sent_at = time.time()
+        started = time.perf_counter()
+        try:
+            connection.request(method, path, body=payload, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            status = None
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+        latency = time.perf_counter() - started
+
+        records.append((kind, sent_at, latency, status))
+
+    connection.close()
+    return records
+
+
+def summarize(records, window_start, window_end):
+    """Compute throughput and latency percentiles for records in a time window."""
+    records = [r for r in records if window_start <= r[1] < window_end]
+    elapsed = window_end - window_start
+    latencies = np.array([r[2] for r in records]) * 1000
+    errors = sum(1 for r in records if r[3] is None or r[3] >= 400)
+
+    if len(records) == 0:
+        return {'requests': 0, 'errors': 0, 'requestsPerSecond': 0.0,
+                'meanMs': None, 'p50Ms': None, 'p95Ms': None, 'p99Ms': None, 'maxMs': None}
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'requests': len(records),
+        'errors': errors,
+        'requestsPerSecond': round(len(records) / elapsed, 2),
+        'meanMs': round(float(latencies.mean()), 2),
+        'p50Ms': round(float(p50), 2),
+        'p95Ms': round(float(p95), 2),
+        'p99Ms': round(float(p99), 2),
+        'maxMs': round(float(latencies.max()), 2)
+    }
+
+
+def git_revision():
+    """Return the current commit hash and whether the tree is dirty."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+        dirty = bool(subprocess.check_output(
+            ['git', 'status', '--porcelain'], cwd=BACKEND_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip())
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+
+def run_load_test(args):
+    """Seed, start the server, replay the mix and return the results document."""
+    weights = parse_mix(args.mix)
+
+    with tempfile.TemporaryDirectory(prefix='loadtest-') as workdir:
+        print(f"Generating {args.pigments} pigments and {args.orders} orders")
+        pigments = generate_pigments(args.pigments, args.seed)
+        orders = generate_orders(args.orders, args.seed)
+        pigments_path = os.path.join(workdir, 'seed_pigments.xlsx')
+        orders_path = os.path.join(workdir, 'seed_orders.xlsx')
+        pigments.to_excel(pigments_path, index=False)
+        orders.to_excel(orders_path, index=False)
+
+        port = free_port()
+        print(f"Starting gunicorn: {args.workers} workers x {args.threads} threads on port {port}")
+        process, seed_report = start_server(args, workdir, port, pigments_path, orders_path)
+        for table, report in seed_report.items():
+            if report['status'] != 200:
+                stop_server(process)
+                raise RuntimeError(f'Seeding {table} failed: {report["body"]}')
+            print(f"Seeded {table}: {report['body'].get('count')} records in {report['seconds']}s")
+
+        # Orders are uploaded last, so their response carries the final version
+        dataset = {
+            'pigmentIds': list(pigments['PigmentID']),
+            'version': seed_report['orders']['body']['version'],
+            'epoch': seed_report['orders']['body']['epoch']
+        }
+
+        sampler = RssSampler(process.pid, args.rss_interval)
+        sampler.start()
+        try:
+            start_at = time.time() + 0.5
+            measure_from = start_at + args.warmup
+            stop_at = measure_from + args.duration
+            print(f"Running {args.clients} clients for {args.warmup}s warmup + {args.duration}s")
+
+            with ThreadPoolExecutor(max_workers=args.clients) as pool:
+                futures = [
+                    pool.submit(run_client, i, port, weights, dataset, args, start_at, stop_at)
+                    for i in range(args.clients)
+                ]
+                records = [record for future in futures for record in future.result()]
+        finally:
+            sampler.stop()
+            stop_server(process)
+
+    window = (measure_from, stop_at)
+
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git': git_revision(),
+        'config': {
+            'workers': args.workers,
+            'threads': args.threads,
+            'pigments': args.pigments,
+            'orders': args.orders,
+            'clients': args.clients,
+            'duration': args.duration,
+            'warmup': args.warmup,
+            'mix': weights,
+            'seed': args.seed
+        },
+        'seed': seed_report,
+        'overall': summarize(records, *window),
+        'byKind': {kind: summarize([r for r in records if r[0] == kind], *window) for kind in weights},
+        'memory': sampler.summary()
+    }
+
+
+def print_results(results):
+    """Print a results document as a readable table."""
+    print("=" * 78)
+    print(f"{'kind':<16}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    print("-" * 78)
+    rows = list(results['byKind'].items()) + [('overall', results['overall'])]
+    for kind, stats in rows:
+        print(f"{kind:<16}{stats['requests']:>10}{stats['errors']:>8}{stats['requestsPerSecond']:>10}"
+              f"{str(stats['p50Ms']):>10}{str(stats['p95Ms']):>10}{str(stats['p99Ms']):>10}")
+    print("-" * 78)
+    memory = results['memory']
+    print(f"Master RSS max: {memory['masterRssMaxMb']} MB")
+    for worker in memory['workers']:
+        print(f"Worker {worker['pid']}: RSS max {worker['rssMaxMb']} MB, end {worker['rssEndMb']} MB")
+    print("=" * 78)
+
+
+def compare_results(baseline_path, candidate_path):
+    """Print metric changes between two saved result files."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(candidate_path) as f:
+        candidate = json.load(f)
+
+    print(f"Baseline:  {baseline['git']['commit']} ({baseline['timestamp']})")
+    print(f"Candidate: {candidate['git']['commit']} ({candidate['timestamp']})")
+    if baseline['config'] != candidate['config']:
+        print("Warning: runs used different configurations")
+
+    print("=" * 78)
+    print(f"{'kind':<16}{'metric':<20}{'baseline':>12}{'candidate':>12}{'change':>12}")
+    print("-" * 78)
+    kinds = [k for k in baseline['byKind'] if k in candidate['byKind']] + ['overall']
+    for kind in kinds:
+        before = baseline['overall'] if kind == 'overall' else baseline['byKind'][kind]
+        after = candidate['overall'] if kind == 'overall' else candidate['byKind'][kind]
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            old, new = before.get(metric), after.get(metric)
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else f"{new - old:+g}"
+            better = (new > old) == higher_is_better if new != old else None
+            marker = '' if better is None else (' better' if better else ' worse')
+            print(f"{kind:<16}{metric:<20}{old:>12}{new:>12}{change:>12}{marker}")
+
+    old_rss = max((w['rssMaxMb'] for w in baseline['memory']['workers']), default=None)
+    new_rss = max((w['rssMaxMb'] for w in candidate['memory']['workers']), default=None)
+    print("-" * 78)
+    print(f"{'workers':<16}{'rssMaxMb':<20}{str(old_rss):>12}{str(new_rss):>12}")
+    print("=" * 78)
+
+
+def parse_args(argv=None):
+    """Parse command-line options."""
+    parser = argparse.ArgumentParser(description='Load-test the matcher API under gunicorn.')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=4, help='threads per worker')
+    parser.add_argument('--pigments', type=int, default=1000, help='synthetic pigments to seed')
+    parser.add_argument('--orders', type=int, default=5000, help='synthetic orders to seed')
+    parser.add_argument('--clients', type=int, default=16, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=5, help='unmeasured seconds before measuring')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'request weights, kinds: {", ".join(REQUEST_KINDS)} (default: {DEFAULT_MIX})')
+    parser.add_argument('--seed', type=int, default=42, help='random seed for data and request mix')
+    parser.add_argument('--timeout', type=int, default=120, help='request and worker timeout in seconds')
+    parser.add_argument('--startup-timeout', type=float, default=300, help='seconds to wait for seeding and boot')
+    parser.add_argument('--rss-interval', type=float, default=1.0, help='seconds between RSS samples')
+    parser.add_argument('--output', help='write the results JSON to this path')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CANDIDATE'),
+                        help='compare two results files instead of running')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.compare:
+        compare_results(*args.compare)
+        sys.exit(0)
+
+    results = run_load_test(args)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")